@@ -5,33 +5,35 @@
 import streamlit as st
 import pandas as pd
 from datetime import datetime, timedelta
-from sqlalchemy import text
+from functools import lru_cache
+from sqlalchemy import bindparam, create_engine, event, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import QueuePool
 import time
-from streamlit_autorefresh import st_autorefresh
+import re
 import hashlib
+import hmac
+import secrets
 import bleach  # For sanitizing user input to prevent XSS attacks
-from textblob import TextBlob
-import nltk
-
-# --- Initial Setup: NLTK Data Download ---
-@st.cache_resource
-def download_nltk_data():
-    """Download the NLTK 'punkt' tokenizer if not already present."""
-    try:
-        nltk.data.find('tokenizers/punkt')
-    except LookupError:
-        nltk.download('punkt', quiet=True)
 
 # --- Constants and Configuration ---
 APP_NAME = "Aura"
 SUPER_ADMIN_USERNAME = st.secrets.get("SUPER_ADMIN_USERNAME", "admin")
 SUPER_ADMIN_DEFAULT_PASS = st.secrets.get("SUPER_ADMIN_DEFAULT_PASS", "aura_admin_123")
 APP_SALT = st.secrets.get("APP_SALT", "a_very_secret_and_secure_salt_string")
+SALT_BYTES = APP_SALT.encode()  # Only used to verify accounts created before per-user scrypt salts
+MAX_RESIDENT_MESSAGES = 200  # Messages kept in each session's local history
+ROW_HTML_CACHE_SIZE = 4 * MAX_RESIDENT_MESSAGES  # Rendered message rows kept for all viewers to share
+ACTIVE_REFRESH_SECONDS = 5   # Message list refresh while the chat is active
+IDLE_REFRESH_SECONDS = 30    # ...and once nothing has been posted for a minute
+ADMIN_REFRESH_SECONDS = 10   # Admin user list refresh, in step with its cache
+WORD_PATTERN = re.compile(r"[A-Za-z]{2,}")  # Messages without a real word skip sentiment analysis
 
 AVATARS = {
     "Wave": "🌊", "Star": "⭐", "Quill": "✒️", "Pixel": "👾",
     "Anchor": "⚓", "Compass": "🧭", "Atom": "⚛️", "Sprout": "🌱"
 }
+AVATAR_LABELS = tuple(AVATARS)
 
 # --- Page and Style Configuration ---
 st.set_page_config(page_title=APP_NAME, page_icon="💬", layout="centered")
@@ -162,74 +164,189 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# --- SQL Statements (compiled once per script run, not per call) ---
+SQL_GET_APP_STATE = text("SELECT key, value FROM app_state;")
+SQL_SEED_APP_STATE = text("INSERT OR IGNORE INTO app_state (key, value) VALUES (:key, :val);")
+SQL_SET_APP_STATE = text("UPDATE app_state SET value = :val WHERE key = :key;")
+SQL_DELETE_OLD_MESSAGES = text("DELETE FROM messages WHERE timestamp < :cutoff;")
+# ts_str is the display time ('%I:%M %p') built by SQLite; strftime only gained %I/%p in 3.46, hence printf.
+# Expired rows are filtered on read, so they never show even while the once-a-minute sweep hasn't deleted them yet.
+SQL_GET_NEW_MESSAGES = text("""
+    SELECT id, username, avatar, message, timestamp,
+           printf('%02d:%s %s', (CAST(strftime('%H', timestamp) AS INTEGER) + 11) % 12 + 1, strftime('%M', timestamp),
+                  CASE WHEN CAST(strftime('%H', timestamp) AS INTEGER) < 12 THEN 'AM' ELSE 'PM' END) AS ts_str
+    FROM messages WHERE id > :last_id AND timestamp >= datetime('now', 'localtime', '-1 hour') ORDER BY id ASC;""")
+SQL_GET_NEWEST_MESSAGE_ID = text("SELECT COALESCE(MAX(id), 0) FROM messages;")
+SQL_INSERT_MESSAGE = text("INSERT INTO messages (username, avatar, message, timestamp, sentiment) VALUES (:u, :a, :m, :ts, :senti);")
+SQL_GET_USER = text("SELECT username, hashed_password, password_salt, avatar, role, status FROM users WHERE username = :u;")
+SQL_CREATE_ADMIN = text("INSERT INTO users (username, hashed_password, password_salt, avatar, role, status) VALUES (:user, :hp, :salt, '👑', 'admin', 'active');")
+SQL_SET_PASSWORD = text("UPDATE users SET hashed_password = :hp, password_salt = :salt WHERE username = :u;")
+SQL_USER_EXISTS = text("SELECT 1 FROM users WHERE username = :u;")
+SQL_REGISTER_USER = text("INSERT INTO users (username, hashed_password, password_salt, avatar) VALUES (:u, :hp, :salt, :a) ON CONFLICT(username) DO NOTHING;")
+SQL_SET_USER_STATUS = text("UPDATE users SET status = :st WHERE username IN :names;").bindparams(bindparam("names", expanding=True))
+# A true upsert: unlike INSERT OR REPLACE it updates the row in place instead of deleting and re-inserting it
+SQL_MUTE_USER = text("INSERT INTO muted_users (username, muted_until) VALUES (:u, :end) ON CONFLICT(username) DO UPDATE SET muted_until = excluded.muted_until;")
+SQL_UNMUTE_USER = text("DELETE FROM muted_users WHERE username = :u;")
+SQL_GET_USER_MUTE = text("SELECT muted_until FROM muted_users WHERE username = :u AND muted_until > :now;")
+SQL_GET_ADMIN_USER_LIST = text("""
+    SELECT u.username, u.avatar, u.role, u.status, m.muted_until FROM (
+        SELECT username, avatar, role, status FROM users WHERE username != :admin
+        UNION ALL
+        SELECT username, MAX(avatar) AS avatar, 'guest' AS role, 'active' AS status FROM messages
+        WHERE username LIKE '%(Guest)' AND timestamp > :time AND username NOT IN (SELECT username FROM users)
+        GROUP BY username
+    ) AS u
+    LEFT JOIN muted_users AS m ON m.username = u.username AND m.muted_until > :now
+    ORDER BY u.username;""")
+
 # --- Database Setup and Helpers ---
-conn = st.connection("chat_db", type="sql", url="sqlite:///aura_app.db")
+# Per-connection settings: trade a little durability and RAM for fewer syscalls.
+# journal_mode=WAL is stored in the database file itself, so init_db sets it once.
+SQLITE_PRAGMAS = ("synchronous=NORMAL", "temp_store=MEMORY", "mmap_size=268435456", "cache_size=-20000")
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Applies per-connection SQLite settings as the pool opens each connection."""
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma};")
+    cursor.close()
+
+@st.cache_resource
+def get_engine():
+    """Creates the pooled engine shared by every session in this process."""
+    # Pooled connections stay open between queries, keeping their page cache warm. A QueuePool rather than a
+    # StaticPool, since one shared connection would serialize the fragment and every session.
+    # The driver's timeout sets SQLite's busy timeout, so brief write locks are waited out rather than raised.
+    engine = create_engine("sqlite:///aura_app.db", connect_args={"check_same_thread": False, "timeout": 5},
+                           poolclass=QueuePool, pool_size=8, max_overflow=10)
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+def query_df(statement, params=None):
+    """Runs a SELECT on a pooled connection and returns the result as a DataFrame."""
+    return pd.read_sql(statement, get_engine(), params=params)
 
+@st.cache_resource
 def init_db():
-    """Initializes the database with required tables and default admin user."""
-    with conn.session as s:
-        s.execute(text("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, hashed_password TEXT NOT NULL, avatar TEXT, role TEXT DEFAULT 'user', status TEXT DEFAULT 'active');"))
-        s.execute(text("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, username TEXT, avatar TEXT, message TEXT, timestamp DATETIME, sentiment REAL);"))
+    """Initializes the database with required tables and default admin user. Runs once per process, not per rerun."""
+    with get_engine().begin() as s:
+        s.execute(text("PRAGMA journal_mode=WAL;"))
+        s.execute(text("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, hashed_password TEXT NOT NULL, avatar TEXT, role TEXT DEFAULT 'user', status TEXT DEFAULT 'active', password_salt TEXT);"))
+        # Accounts from before per-user salts have no password_salt and are upgraded on their next login
+        user_columns = {row[1] for row in s.execute(text("PRAGMA table_info(users);"))}
+        if 'password_salt' not in user_columns:
+            s.execute(text("ALTER TABLE users ADD COLUMN password_salt TEXT;"))
+        # AUTOINCREMENT keeps ids rising after the hourly sweep empties the table, since sessions fetch by id
+        s.execute(text("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, avatar TEXT, message TEXT, timestamp DATETIME, sentiment REAL);"))
+        messages_sql = s.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages';")).scalar()
+        if 'AUTOINCREMENT' not in messages_sql.upper():
+            # Tables from before AUTOINCREMENT can hand out a freed id again, so rebuild them with it
+            s.execute(text("CREATE TABLE messages_new (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, avatar TEXT, message TEXT, timestamp DATETIME, sentiment REAL);"))
+            s.execute(text("INSERT INTO messages_new (id, username, avatar, message, timestamp, sentiment) SELECT id, username, avatar, message, timestamp, sentiment FROM messages;"))
+            s.execute(text("DROP TABLE messages;"))
+            s.execute(text("ALTER TABLE messages_new RENAME TO messages;"))
+        s.execute(text("CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(timestamp);"))
         s.execute(text("CREATE TABLE IF NOT EXISTS app_state (key TEXT PRIMARY KEY, value TEXT);"))
         s.execute(text("CREATE TABLE IF NOT EXISTS muted_users (username TEXT PRIMARY KEY, muted_until DATETIME NOT NULL);"))
         
-        admin_user = s.execute(text("SELECT 1 FROM users WHERE username = :user;"), params=dict(user=SUPER_ADMIN_USERNAME)).fetchone()
+        admin_user = s.execute(SQL_USER_EXISTS, dict(u=SUPER_ADMIN_USERNAME)).fetchone()
         if not admin_user:
-            hashed_pass = hash_password(SUPER_ADMIN_DEFAULT_PASS)
-            s.execute(text("INSERT INTO users (username, hashed_password, avatar, role, status) VALUES (:user, :hp, '👑', 'admin', 'active');"), params=dict(user=SUPER_ADMIN_USERNAME, hp=hashed_pass))
+            salt = new_password_salt()
+            s.execute(SQL_CREATE_ADMIN, dict(user=SUPER_ADMIN_USERNAME, hp=hash_password(SUPER_ADMIN_DEFAULT_PASS, salt), salt=salt))
         
-        s.execute(text("INSERT OR IGNORE INTO app_state (key, value) VALUES ('chat_mute_until', '2000-01-01 00:00:00');"))
-        s.execute(text("INSERT OR IGNORE INTO app_state (key, value) VALUES ('guest_login_disabled', 'false');"))
-        s.commit()
+        s.execute(SQL_SEED_APP_STATE, [dict(key='chat_mute_until', val='2000-01-01 00:00:00'),
+                                       dict(key='guest_login_disabled', val='false')])
 
 # --- Security and Utility Functions ---
 def sanitize_input(raw_input):
     """Sanitizes user input to prevent XSS attacks."""
     return bleach.clean(raw_input)
 
-def hash_password(password):
-    """Hashes a password with a salt using SHA256."""
-    return hashlib.sha256((password + APP_SALT).encode()).hexdigest()
+def new_password_salt():
+    """Generates a random per-user salt, hex encoded for storage."""
+    return secrets.token_hex(16)
+
+def hash_password(password, salt):
+    """Hashes a password with the user's salt using scrypt, which is memory-hard and slow to brute-force."""
+    return hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=16384, r=8, p=1, dklen=32).hex()
+
+def hash_password_legacy(password):
+    """Hashes a password the pre-scrypt way: SHA256 with the app-wide salt (hashlib's OpenSSL backend, SHA-NI accelerated where available)."""
+    digest = hashlib.sha256(password.encode())
+    digest.update(SALT_BYTES)
+    return digest.hexdigest()
 
-def verify_password(stored_hash, provided_password):
-    """Verifies a provided password against a stored hash."""
-    return stored_hash == hash_password(provided_password)
+def verify_password(stored_hash, provided_password, salt):
+    """Verifies a provided password against a stored hash. Accounts without a salt still use the legacy hash."""
+    if salt is None:
+        return hmac.compare_digest(stored_hash, hash_password_legacy(provided_password))
+    return hmac.compare_digest(stored_hash, hash_password(provided_password, salt))
+
+@st.cache_resource
+def get_cleanup_tracker():
+    """Process-wide record of when old messages were last cleared."""
+    return {"last_run": 0.0}
 
 def clear_old_messages():
-    """Deletes messages older than 1 hour to keep the chat fresh."""
-    cutoff_time = datetime.now() - timedelta(hours=1)
-    with conn.session as s:
-        s.execute(text("DELETE FROM messages WHERE timestamp < :cutoff;"), params=dict(cutoff=cutoff_time))
-        s.commit()
+    """Deletes messages older than 1 hour to keep the chat fresh. Runs at most once per minute."""
+    tracker = get_cleanup_tracker()
+    if time.time() - tracker["last_run"] < 60:
+        return
+    tracker["last_run"] = time.time()
 
-def analyze_sentiment(text_message):
+    with get_engine().begin() as s:
+        s.execute(SQL_DELETE_OLD_MESSAGES, dict(cutoff=datetime.now() - timedelta(hours=1)))
+
+@st.cache_resource
+def get_sentiment_analyzer():
+    """Loads the VADER lexicon once per process so the first chatter doesn't pay for it."""
+    # Imported here so the welcome, login and register screens never load it
+    from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+    return SentimentIntensityAnalyzer()
+
+@lru_cache(maxsize=4096)  # Chat repeats itself ("lol", "thanks!"), so identical texts are scored once
+def score_message(text_message, analyzer):
+    """Runs VADER on a message and returns its compound score."""
+    return analyzer.polarity_scores(text_message)["compound"]
+
+def analyze_sentiment(text_message, analyzer):
     """Analyzes the sentiment polarity of a message."""
-    return TextBlob(text_message).sentiment.polarity
+    # Very short or wordless messages (e.g. "hi", emoji) always score neutral; checked ahead of the cache so they don't take its slots
+    if len(text_message) < 3 or not WORD_PATTERN.search(text_message):
+        return 0.0
+    return score_message(text_message, analyzer)
 
 # --- Cached Data Fetching ---
 @st.cache_data(ttl=5)
 def get_app_state():
-    """Fetches global app state from the database."""
-    return conn.query("SELECT key, value FROM app_state;", ttl=0)
-
-@st.cache_data(ttl=3)
-def get_all_messages():
-    """Fetches all recent messages."""
-    return conn.query("SELECT * FROM messages ORDER BY timestamp ASC;", ttl=0)
+    """Fetches global app state from the database as a key -> value dict."""
+    return dict(query_df(SQL_GET_APP_STATE).itertuples(index=False))
+
+@st.cache_data(ttl=4)  # Takes no arguments, so every viewer shares one lookup per tick
+def get_newest_message_id():
+    """Fetches the newest message id, the change token that tells a session whether there is anything to fetch."""
+    with get_engine().connect() as s:
+        return s.execute(SQL_GET_NEWEST_MESSAGE_ID).scalar()
+
+@st.cache_data(ttl=4)  # Just under the 5s refresh, so concurrent viewers share one result
+def get_new_messages(last_id):
+    """Fetches messages posted after the given message id, as plain dicts ready for session state."""
+    # Rows go straight to dicts; a DataFrame here would only be built to be taken apart again
+    with get_engine().connect() as s:
+        return [row._asdict() for row in s.execute(SQL_GET_NEW_MESSAGES, dict(last_id=last_id))]
 
 @st.cache_data(ttl=10)
 def get_all_users_for_admin():
-    """Fetches all registered and active guest users for the admin panel."""
-    registered = conn.query("SELECT username, avatar, role, status FROM users WHERE username != :admin;", params=dict(admin=SUPER_ADMIN_USERNAME), ttl=0)
-    cutoff = datetime.now() - timedelta(hours=1)
-    guests = conn.query("SELECT DISTINCT username, avatar FROM messages WHERE username LIKE '%(Guest)' AND timestamp > :time;", params=dict(time=cutoff), ttl=0)
-    guests['role'], guests['status'] = 'guest', 'active'
-    return pd.concat([registered, guests]).drop_duplicates(subset=['username'])
+    """Fetches all registered and active guest users, with any active mute, for the admin panel."""
+    now = datetime.now()
+    users = query_df(SQL_GET_ADMIN_USER_LIST, params=dict(admin=SUPER_ADMIN_USERNAME, time=now - timedelta(hours=1), now=now))
+    users['muted_until'] = pd.to_datetime(users['muted_until'])
+    return users
 
 @st.cache_data(ttl=5)
 def get_user_mute_status(username):
     """Checks if a specific user is currently muted."""
-    return conn.query("SELECT muted_until FROM muted_users WHERE username = :u AND muted_until > :now", params=dict(u=username, now=datetime.now()), ttl=0)
+    return query_df(SQL_GET_USER_MUTE, params=dict(u=username, now=datetime.now()))
 
 # --- UI Screens ---
 def show_welcome_screen():
@@ -250,7 +367,7 @@ def show_welcome_screen():
                 st.session_state.screen = "register"; st.rerun()
             
             app_state = get_app_state()
-            guest_disabled = app_state[app_state['key'] == 'guest_login_disabled'].iloc[0]['value'] == 'true'
+            guest_disabled = app_state['guest_login_disabled'] == 'true'
             if not guest_disabled:
                 if st.button("👤 Continue as Guest", use_container_width=True):
                     st.session_state.screen = "guest_setup"; st.rerun()
@@ -268,9 +385,15 @@ def show_login_screen():
             submitted = st.form_submit_button("Login", use_container_width=True)
             if submitted:
                 clean_username = sanitize_input(username)
-                user = conn.query("SELECT * FROM users WHERE username = :u;", params=dict(u=clean_username), ttl=0)
-                if not user.empty and verify_password(user.iloc[0]['hashed_password'], password):
-                    user_data = user.iloc[0]
+                # A single row is read as a Row; a DataFrame would only add overhead here
+                with get_engine().connect() as s:
+                    user_data = s.execute(SQL_GET_USER, dict(u=clean_username)).mappings().first()
+                if user_data is not None and verify_password(user_data['hashed_password'], password, user_data['password_salt']):
+                    if user_data['password_salt'] is None:
+                        # Upgrade a legacy SHA256 account to scrypt now that we have the plaintext
+                        salt = new_password_salt()
+                        with get_engine().begin() as s:
+                            s.execute(SQL_SET_PASSWORD, dict(hp=hash_password(password, salt), salt=salt, u=user_data['username']))
                     if user_data['status'] == 'banned':
                         st.error("This account has been banned.")
                     else:
@@ -280,8 +403,8 @@ def show_login_screen():
                         st.session_state.role = user_data['role']
                         st.session_state.screen = "chat"
                         
-                        default_pass_hash = hash_password(SUPER_ADMIN_DEFAULT_PASS)
-                        if user_data['role'] == 'admin' and user_data['hashed_password'] == default_pass_hash:
+                        # The password just verified, so comparing it to the default needs no second hash
+                        if user_data['role'] == 'admin' and hmac.compare_digest(password.encode(), SUPER_ADMIN_DEFAULT_PASS.encode()):
                             st.session_state.admin_using_default_pass = True
                         
                         st.success("Login successful!"); time.sleep(1.5); st.rerun()
@@ -298,7 +421,7 @@ def show_register_screen():
         with st.form("register_form"):
             username = st.text_input("Username", placeholder="Choose a unique username")
             password = st.text_input("Password", type="password", placeholder="Choose a secure password")
-            avatar_label = st.selectbox("Choose Your Avatar", options=list(AVATARS.keys()))
+            avatar_label = st.selectbox("Choose Your Avatar", options=AVATAR_LABELS)
             submitted = st.form_submit_button("Register", use_container_width=True)
             if submitted:
                 clean_username = sanitize_input(username)
@@ -306,15 +429,18 @@ def show_register_screen():
                     st.warning("Please fill out all fields.")
                 else:
                     try:
-                        with conn.session as s:
-                            s.execute(text("INSERT INTO users (username, hashed_password, avatar) VALUES (:u, :hp, :a);"), params=dict(u=clean_username, hp=hash_password(password), a=AVATARS[avatar_label]))
-                            s.commit()
+                        with get_engine().begin() as s:
+                            salt = new_password_salt()
+                            created = s.execute(SQL_REGISTER_USER, dict(u=clean_username, hp=hash_password(password, salt), salt=salt, a=AVATARS[avatar_label])).rowcount
+                    except SQLAlchemyError:
+                        created = None
+                    if created is None:
+                        st.error("An unexpected error occurred.")
+                    elif created == 0:
+                        st.error("Username already exists.")
+                    else:
                         st.success("Registration successful! Please log in."); time.sleep(1.5)
                         st.session_state.screen = "login"; st.rerun()
-                    except Exception as e:
-                        if "UNIQUE constraint failed" in str(e):
-                            st.error("Username already exists.")
-                        else: st.error("An unexpected error occurred.")
         if st.button("← Back to Welcome", use_container_width=True):
             st.session_state.screen = "welcome"; st.rerun()
         st.markdown('</div>', unsafe_allow_html=True)
@@ -325,15 +451,16 @@ def show_guest_setup_screen():
         st.markdown('<h2 style="text-align: center;">Guest Setup</h2>', unsafe_allow_html=True)
         with st.form("guest_form"):
             username = st.text_input("Guest Username", placeholder="Enter a temporary name")
-            avatar_label = st.selectbox("Choose Your Avatar", options=list(AVATARS.keys()))
+            avatar_label = st.selectbox("Choose Your Avatar", options=AVATAR_LABELS)
             submitted = st.form_submit_button("Enter Chat", use_container_width=True)
             if submitted:
                 clean_username = sanitize_input(username)
                 if not clean_username:
                     st.warning("Please enter a username.")
                 else:
-                    user_exists = conn.query("SELECT 1 FROM users WHERE username = :u", params=dict(u=clean_username), ttl=0)
-                    if not user_exists.empty:
+                    with get_engine().connect() as s:
+                        user_exists = s.execute(SQL_USER_EXISTS, dict(u=clean_username)).first() is not None
+                    if user_exists:
                         st.error("This name is taken by a registered user. Please choose another.")
                     else:
                         st.session_state.logged_in = True
@@ -346,155 +473,254 @@ def show_guest_setup_screen():
             st.session_state.screen = "welcome"; st.rerun()
         st.markdown('</div>', unsafe_allow_html=True)
 
-def show_admin_dashboard():
+def show_admin_dashboard(app_state):
     st.subheader("🛡️ Admin Panel", anchor=False)
     
     # --- Global Chat Controls ---
     st.markdown("##### Global Chat Controls")
-    app_state = get_app_state()
-    chat_mute_until = pd.to_datetime(app_state[app_state['key'] == 'chat_mute_until'].iloc[0]['value'])
+    chat_mute_until = pd.to_datetime(app_state['chat_mute_until'])
     
     if chat_mute_until > datetime.now():
         st.warning(f"Chat is globally muted until {chat_mute_until.strftime('%H:%M:%S')}", icon="🔇")
         if st.button("Lift Mute", use_container_width=True):
-            with conn.session as s: s.execute(text("UPDATE app_state SET value = :val WHERE key = 'chat_mute_until'"), params=dict(val=datetime.now() - timedelta(minutes=1))); s.commit()
+            with get_engine().begin() as s: s.execute(SQL_SET_APP_STATE, dict(key='chat_mute_until', val=datetime.now() - timedelta(minutes=1)))
             st.rerun()
     else:
         duration = st.selectbox("Mute entire chat for:", options=["5 Minutes", "15 Minutes", "1 Hour"], key="global_mute_dur")
         if st.button("Mute Entire Chat", use_container_width=True):
             duration_map = {"5 Minutes": 5, "15 Minutes": 15, "1 Hour": 60}
             mute_end = datetime.now() + timedelta(minutes=duration_map[duration])
-            with conn.session as s: s.execute(text("UPDATE app_state SET value = :val WHERE key = 'chat_mute_until'"), params=dict(val=mute_end)); s.commit()
+            with get_engine().begin() as s: s.execute(SQL_SET_APP_STATE, dict(key='chat_mute_until', val=mute_end))
             st.rerun()
 
-    guest_disabled = app_state[app_state['key'] == 'guest_login_disabled'].iloc[0]['value'] == 'true'
+    guest_disabled = app_state['guest_login_disabled'] == 'true'
     if guest_disabled:
         if st.button("✅ Enable Guest Login", use_container_width=True):
-            with conn.session as s: s.execute(text("UPDATE app_state SET value='false' WHERE key='guest_login_disabled'")); s.commit()
+            with get_engine().begin() as s: s.execute(SQL_SET_APP_STATE, dict(key='guest_login_disabled', val='false'))
             st.rerun()
     else:
         if st.button("🚫 Disable Guest Login", type="primary", use_container_width=True):
-            with conn.session as s: s.execute(text("UPDATE app_state SET value='true' WHERE key='guest_login_disabled'")); s.commit()
+            with get_engine().begin() as s: s.execute(SQL_SET_APP_STATE, dict(key='guest_login_disabled', val='true'))
             st.rerun()
     
     st.divider()
 
     # --- User Management ---
     st.markdown("##### User Management")
-    all_users = get_all_users_for_admin()
-    muted_users = conn.query("SELECT username FROM muted_users WHERE muted_until > :now", params=dict(now=datetime.now()), ttl=5)['username'].tolist()
-    
-    if all_users.empty: st.write("No other active users found.")
+    st.fragment(show_user_management, run_every=ADMIN_REFRESH_SECONDS)()
+
+def show_user_management():
+    """Lists users with their status and mute. Runs as a fragment so the list stays current between full reruns."""
+    # The editor reports edits against the frame it was drawn from, so only pin that frame while edits are unsaved
+    if 'admin_users' not in st.session_state or not st.session_state.get('user_editor', {}).get('edited_rows'):
+        st.session_state.admin_users = get_all_users_for_admin().set_index("username")
+    all_users = st.session_state.admin_users
     
-    for _, user in all_users.iterrows():
-        is_muted = user['username'] in muted_users
-        st.markdown(f"**{user['avatar']} {user['username']}** (`{user['role']}`)")
-        c1, c2 = st.columns(2)
-        with c1:
-            if is_muted:
-                if st.button("Unmute", key=f"unmute_{user['username']}", use_container_width=True):
-                    with conn.session as s: s.execute(text("DELETE FROM muted_users WHERE username = :u"), params=dict(u=user['username'])); s.commit()
-                    st.rerun()
-            else:
-                if st.button("Mute (15 min)", key=f"mute_{user['username']}", use_container_width=True):
-                    end = datetime.now() + timedelta(minutes=15)
-                    with conn.session as s: s.execute(text("INSERT OR REPLACE INTO muted_users (username, muted_until) VALUES (:u, :end)"), params=dict(u=user['username'], end=end)); s.commit()
-                    st.rerun()
-        if user['role'] != 'guest':
-            with c2:
-                if user['status'] == 'active':
-                    if st.button("Ban", key=f"ban_{user['username']}", type="primary", use_container_width=True):
-                        with conn.session as s: s.execute(text("UPDATE users SET status = 'banned' WHERE username = :u"), params=dict(u=user['username'])); s.commit()
-                        st.rerun()
-                else:
-                    if st.button("Unban", key=f"unban_{user['username']}", use_container_width=True):
-                        with conn.session as s: s.execute(text("UPDATE users SET status = 'active' WHERE username = :u"), params=dict(u=user['username'])); s.commit()
-                        st.rerun()
-        st.markdown("---")
+    if all_users.empty:
+        st.write("No other active users found.")
+    else:
+        c1, c2 = st.columns([2, 1])
+        target = c1.selectbox("User", options=all_users.index, key="quick_mute_user", label_visibility="collapsed")
+        if c2.button("Mute (15 min)", use_container_width=True):
+            end = datetime.now() + timedelta(minutes=15)
+            with get_engine().begin() as s: s.execute(SQL_MUTE_USER, dict(u=target, end=end))
+            reset_user_editor()
+            st.rerun()
 
+        # One editor for every user instead of a row of buttons per user
+        st.caption("Set a status or a mute end time, then save. Clear the mute time to unmute.")
+        edited = st.data_editor(
+            all_users, key="user_editor", use_container_width=True,
+            column_config={
+                "_index": st.column_config.TextColumn("User"),
+                "avatar": st.column_config.TextColumn("", width="small"),
+                "status": st.column_config.SelectboxColumn("Status", options=["active", "banned"], required=True),
+                "muted_until": st.column_config.DatetimeColumn("Muted Until", format="HH:mm"),
+            },
+            disabled=["avatar", "role"],
+        )
+        if st.button("Save Changes", use_container_width=True):
+            save_user_edits(all_users, edited)
+
+    if st.button("↻ Refresh User List", use_container_width=True):
+        reset_user_editor()
+        st.rerun()
 
-def show_chat_screen():
+def reset_user_editor():
+    """Drops the admin user snapshot and any unsaved edits so the next run reloads the user list."""
+    get_all_users_for_admin.clear()
+    get_user_mute_status.clear()
+    st.session_state.pop('admin_users', None)
+    st.session_state.pop('user_editor', None)
+
+def save_user_edits(original, edited):
+    """Applies the status and mute differences between the admin editor's frame and the one it was drawn from."""
+    old_mutes, new_mutes = original['muted_until'], pd.to_datetime(edited['muted_until'])
+    mute_changed = ~((old_mutes == new_mutes) | (old_mutes.isna() & new_mutes.isna()))
+    status_changed = edited['status'] != original['status']
+
+    guest_edits = original.index[status_changed & (original['role'] == 'guest')]
+    if len(guest_edits):
+        st.warning(f"Guests can't be banned, only muted: {', '.join(guest_edits)}. Nothing was saved.", icon="⚠️")
+        return
+
+    mutes = [dict(u=u, end=end.to_pydatetime()) for u, end in new_mutes[mute_changed].dropna().items()]
+    unmutes = [dict(u=u) for u in new_mutes[mute_changed & new_mutes.isna()].index]
+    with get_engine().begin() as s:
+        # Passing a list of parameter sets runs each statement as a single executemany
+        if mutes:
+            s.execute(SQL_MUTE_USER, mutes)
+        if unmutes:
+            s.execute(SQL_UNMUTE_USER, unmutes)
+        # At most one UPDATE per target status, however many users changed
+        for status in ("active", "banned"):
+            usernames = edited.index[status_changed & (edited['status'] == status)].tolist()
+            if usernames:
+                s.execute(SQL_SET_USER_STATUS, dict(st=status, names=usernames))
+    reset_user_editor()
+    st.rerun()
+
+def get_refresh_interval():
+    """Polls quickly while messages are arriving and backs off once the chat has been quiet for a minute."""
+    messages = st.session_state.get('messages')
+    if messages and datetime.now() - datetime.fromisoformat(str(messages[-1]['timestamp'])) < timedelta(minutes=1):
+        return ACTIVE_REFRESH_SECONDS
+    return IDLE_REFRESH_SECONDS
+
+def get_chat_locks(app_state, user_mute_status):
+    """Works out what currently keeps the user from posting: a global mute, their own mute, or the send cooldown."""
+    is_globally_muted = pd.to_datetime(app_state['chat_mute_until']) > datetime.now() and st.session_state.role != 'admin'
+    muted_until = None if user_mute_status.empty else pd.to_datetime(user_mute_status.iloc[0]['muted_until'])
+    is_rate_limited = (datetime.now() - st.session_state.last_message_time).total_seconds() < 3.0 # 3 second cooldown
+    return is_globally_muted, muted_until, is_rate_limited
+
+def message_html(row, is_current_user):
+    """Builds the avatar and chat bubble for one message as a single line of HTML."""
+    align_class = "current-user" if is_current_user else "other-user"
+    avatar = f"<div class='avatar'>{row['avatar']}</div>"
+    # A blank line would end markdown's HTML block and break every bubble after it, so line breaks become <br>
+    text_html = "<br>".join(row["message"].splitlines())
+    bubble = (f'<div class="chat-bubble {align_class}"><b style="font-weight: 600;">{row["username"]}</b>'
+              f'<p style="margin: 0; color: inherit;">{text_html}</p>'
+              f'<div style="font-size: 0.7rem; text-align: right; opacity: 0.8;">{row["ts_str"]}</div></div>')
+    # The container is a flexbox, so the avatar sits on the outer side of the bubble
+    return f'<div class="message-container {align_class}">{bubble + avatar if is_current_user else avatar + bubble}</div>'
+
+@st.cache_resource
+def get_row_html_cache():
+    """Process-wide cache of rendered message rows, shared by every viewer."""
+    return {}
+
+def cached_message_html(row, is_current_user):
+    """Returns a stored message's HTML, building it only the first time any viewer shows it."""
+    # Messages are never edited, so id, timestamp and side pin down the HTML; the timestamp keeps a reused id
+    # (from a replaced or pre-AUTOINCREMENT database) from picking up another message's bubble
+    cache = get_row_html_cache()
+    key = (row['id'], str(row['timestamp']), is_current_user)
+    html = cache.get(key)
+    if html is None:
+        if len(cache) >= ROW_HTML_CACHE_SIZE:
+            # Keys go in roughly in id order, so the oldest messages are evicted first
+            for old_key in list(cache)[:len(cache) // 2]:
+                cache.pop(old_key, None)
+        html = cache[key] = message_html(row, is_current_user)
+    return html
+
+def render_messages():
+    """Renders the message list. Runs as a fragment so it refreshes on its own without rerunning the full page."""
     clear_old_messages()
-    st_autorefresh(interval=5000, limit=None, key="chat_refresh")
+
+    # Only fetch what arrived since the last tick and keep a bounded window in session state
+    if 'messages' not in st.session_state:
+        st.session_state.messages = []
+        # A new session only needs the most recent window, not the full hour of history
+        st.session_state.last_msg_id = max(0, get_newest_message_id() - MAX_RESIDENT_MESSAGES)
+    if get_newest_message_id() < st.session_state.last_msg_id:
+        # The shared lookup can trail this session's own send or fetch by a few seconds, so confirm before acting
+        with get_engine().connect() as s:
+            newest_id = s.execute(SQL_GET_NEWEST_MESSAGE_ID).scalar()
+        if newest_id < st.session_state.last_msg_id:
+            # Ids only go backwards when the database itself was replaced, so start the window over
+            get_newest_message_id.clear()
+            st.session_state.messages = []
+            st.session_state.last_msg_id = max(0, newest_id - MAX_RESIDENT_MESSAGES)
+    # An idle room costs one shared MAX(id) lookup per tick instead of a per-session fetch
+    new_messages = get_new_messages(st.session_state.last_msg_id) if get_newest_message_id() > st.session_state.last_msg_id else []
+    if new_messages:
+        st.session_state.messages.extend(new_messages)
+        st.session_state.last_msg_id = new_messages[-1]['id']
+    cutoff = str(datetime.now() - timedelta(hours=1))
+    st.session_state.messages = [m for m in st.session_state.messages if str(m['timestamp']) >= cutoff][-MAX_RESIDENT_MESSAGES:]
+
+    # The fragment's interval is fixed when it's created, and the chat input and mute banners are drawn by the
+    # full script, so a speed switch or a mute or cooldown starting or ending each need a full rerun
+    interval_changed = get_refresh_interval() != st.session_state.refresh_interval
+    locks_changed = get_chat_locks(get_app_state(), get_user_mute_status(st.session_state.username)) != st.session_state.chat_locks
+    if interval_changed or locks_changed:
+        st.rerun(scope="app")
+
+    # One markdown element for the whole list instead of columns and two elements per message
+    username = st.session_state.username
+    st.markdown("".join(cached_message_html(row, row["username"] == username) for row in st.session_state.messages), unsafe_allow_html=True)
+
+
+def show_chat_screen():
+    get_sentiment_analyzer()  # Warm the lexicon before the first message is sent
+    app_state = get_app_state()
+    user_mute_status = get_user_mute_status(st.session_state.username)
+    if 'last_message_time' not in st.session_state:
+        st.session_state.last_message_time = datetime.min
+    is_globally_muted, muted_until, is_rate_limited = st.session_state.chat_locks = get_chat_locks(app_state, user_mute_status)
 
     with st.sidebar:
         st.title(f"{st.session_state.avatar} {st.session_state.username}")
         st.caption(f"Role: {st.session_state.role.capitalize()}")
         if st.button("Log Out", use_container_width=True):
-            for key in list(st.session_state.keys()): del st.session_state[key]
+            st.session_state.clear()
             st.rerun()
         
         if st.session_state.role == 'admin':
             st.divider()
             if st.session_state.get("admin_using_default_pass", False):
                 st.warning("Using default admin password. Change it for security.", icon="⚠️")
-            show_admin_dashboard()
+            show_admin_dashboard(app_state)
     
     st.markdown(f'<p class="aura-title" style="font-size: 3rem;">{APP_NAME}</p>', unsafe_allow_html=True)
     
     chat_container = st.container(height=500, border=False)
-    messages_df = get_all_messages()
-    for _, row in messages_df.iterrows():
-        is_current_user = row["username"] == st.session_state.username
-        align_class = "current-user" if is_current_user else "other-user"
-        
-        with chat_container:
-            # A more robust way to create columns that avoids overlap
-            cols = st.columns([0.8, 10] if not is_current_user else [10, 0.8])
-            avatar_col = cols[0] if not is_current_user else cols[1]
-            message_col = cols[1] if not is_current_user else cols[0]
-            
-            with avatar_col:
-                st.markdown(f"<div class='avatar'>{row['avatar']}</div>", unsafe_allow_html=True)
-            with message_col:
-                bubble_html = f"""
-                <div class="message-container {align_class}">
-                    <div class="chat-bubble {align_class}">
-                        <b style="font-weight: 600;">{row['username']}</b>
-                        <p style="margin: 0; color: inherit;">{row['message']}</p>
-                        <div style="font-size: 0.7rem; text-align: right; opacity: 0.8;">
-                            {pd.to_datetime(row['timestamp']).strftime('%I:%M %p')}
-                        </div>
-                    </div>
-                </div>"""
-                st.markdown(bubble_html, unsafe_allow_html=True)
+    with chat_container:
+        st.session_state.refresh_interval = get_refresh_interval()
+        st.fragment(render_messages, run_every=st.session_state.refresh_interval)()
 
     # Check Mute Status
-    app_state = get_app_state()
-    global_mute_until = pd.to_datetime(app_state[app_state['key'] == 'chat_mute_until'].iloc[0]['value'])
-    is_globally_muted = global_mute_until > datetime.now()
-    user_mute_status = get_user_mute_status(st.session_state.username)
-    is_individually_muted = not user_mute_status.empty
+    chat_disabled = is_globally_muted or muted_until is not None
     
-    chat_disabled = (is_globally_muted and st.session_state.role != 'admin') or is_individually_muted
-    
-    if is_globally_muted and st.session_state.role != 'admin':
+    if is_globally_muted:
         st.info("The chat is currently muted by an administrator.", icon="🔇")
-    elif is_individually_muted:
-        mute_end_time = pd.to_datetime(user_mute_status.iloc[0]['muted_until']).strftime('%I:%M %p')
-        st.error(f"You have been muted. You can chat again after {mute_end_time}.", icon="🔇")
-
-    # Anti-Spam Rate Limiting
-    if 'last_message_time' not in st.session_state:
-        st.session_state.last_message_time = datetime.min
-    
-    time_since_last_message = (datetime.now() - st.session_state.last_message_time).total_seconds()
-    is_rate_limited = time_since_last_message < 3.0 # 3 second cooldown
+    elif muted_until is not None:
+        st.error(f"You have been muted. You can chat again after {muted_until.strftime('%I:%M %p')}.", icon="🔇")
 
     prompt = st.chat_input("Share a thought...", disabled=chat_disabled or is_rate_limited)
     if prompt:
         clean_prompt = sanitize_input(prompt)
-        sentiment_score = analyze_sentiment(clean_prompt)
-        with conn.session as s:
-            s.execute(text("INSERT INTO messages (username, avatar, message, timestamp, sentiment) VALUES (:u, :a, :m, :ts, :senti);"),
-                      params=dict(u=st.session_state.username, a=st.session_state.avatar, m=clean_prompt, ts=datetime.now(), senti=sentiment_score))
-            s.commit()
+        sentiment_score = analyze_sentiment(clean_prompt, get_sentiment_analyzer())
+        message = dict(username=st.session_state.username, avatar=st.session_state.avatar, message=clean_prompt, timestamp=datetime.now())
+        with get_engine().begin() as s:
+            result = s.execute(SQL_INSERT_MESSAGE,
+                               dict(u=message['username'], a=message['avatar'], m=message['message'], ts=message['timestamp'], senti=sentiment_score))
         st.session_state.last_message_time = datetime.now()
+        if result.lastrowid == st.session_state.last_msg_id + 1:
+            # Nothing was posted in between, so append locally instead of fetching it back
+            st.session_state.messages.append(dict(message, id=result.lastrowid, timestamp=str(message['timestamp']), ts_str=message['timestamp'].strftime('%I:%M %p')))
+            st.session_state.last_msg_id = result.lastrowid
+        else:
+            # The poster should see their own message right away rather than after the caches expire
+            get_newest_message_id.clear()
+            get_new_messages.clear()
         st.rerun()
 
 # --- Main App Logic ---
 def main():
-    download_nltk_data()
     init_db()
 
     if 'screen' not in st.session_state: